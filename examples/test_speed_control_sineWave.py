@@ -1,7 +1,7 @@
 
 from zlac8015d import ZLAC8015D
 import time
-import numpy as np
+import math
 import threading
 
 global motors
@@ -39,8 +39,8 @@ while True:
 
 		## we change speed at every inc_t
 		if (time.time() - last_stamp) > inc_t:
-			rpmL_cmd = 50.0*np.sin((2*np.pi/wave_period)*t)
-			rpmR_cmd = -50.0*np.sin((2*np.pi/wave_period)*t)
+			rpmL_cmd = 50.0*math.sin((2*math.pi/wave_period)*t)
+			rpmR_cmd = -50.0*math.sin((2*math.pi/wave_period)*t)
 
 			t += inc_t
 			if t > wave_period:
@@ -10,7 +10,6 @@ setup(
     packages=['zlac8015d',],
     install_requires = [
         'pymodbus',
-        'numpy',
         'pyserial'
     ]
 )
@@ -1,302 +1,806 @@
-import numpy as np
-from pymodbus.client import ModbusSerialClient as ModbusClient
-
+import asyncio
+import logging
+import math
+import struct
+import time
 
-class Controller:
-    def __init__(self, **kwargs):
-        self.client = ModbusClient(
-            method="rtu",
-            port=kwargs.get("port", "/dev/ttyUSB0"),
-            baudrate=kwargs.get("baudrate", 115200),
-            timeout=kwargs.get("timeout", 1),
-        )
-
-        self.client.connect()
+from pymodbus.client import AsyncModbusSerialClient as AsyncModbusClient
+from pymodbus.client import ModbusSerialClient as ModbusClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+log = logging.getLogger(__name__)
+
+## Prebuilt requests can go straight to client.execute(request) on pymodbus 3.0..3.6,
+## later versions changed both the request class and the execute() signature
+try:
+    from pymodbus import __version__ as _PYMODBUS_VERSION
+    from pymodbus.register_read_message import ReadHoldingRegistersRequest
+
+    _PREBUILT_REQUESTS = (
+        (3, 0) <= tuple(int(v) for v in _PYMODBUS_VERSION.split(".")[:2]) < (3, 7)
+    )
+except (ImportError, ValueError):
+    _PREBUILT_REQUESTS = False
+
+## 4 position feedback words (HI, LO per wheel) -> 2 signed 32-bit ticks
+_POS_PACK = struct.Struct(">HHHH").pack
+_POS_UNPACK = struct.Struct(">ii").unpack
+## 8 words from L_FAULT to R_FB_RPM -> 2 fault codes, 2 signed 32-bit ticks, 2 signed rpm
+_STATUS_PACK = struct.Struct(">8H").pack
+_STATUS_UNPACK = struct.Struct(">HHiihh").unpack
+
+
+## The longest exchange, an 8-register read, is ~29 bytes of 11 bits on the wire.
+## Allow 10 times that for the driver to answer, but never less than 50 ms.
+def _default_timeout(baudrate):
+    return max(0.05, 10 * 29 * 11 / baudrate)
+
+
+class _ControllerBase:
+    ######################
+    ## Register Address ##
+    ######################
+    ## Common
+    CONTROL_REG = 0x200E
+    OPR_MODE = 0x200D
+    L_ACL_TIME = 0x2080
+    R_ACL_TIME = 0x2081
+    L_DCL_TIME = 0x2082
+    R_DCL_TIME = 0x2083
+
+    ## Velocity control
+    L_CMD_RPM = 0x2088
+    R_CMD_RPM = 0x2089
+    L_FB_RPM = 0x20AB
+    R_FB_RPM = 0x20AC
+
+    ## Position control
+    POS_CONTROL_TYPE = 0x200F
+
+    L_MAX_RPM_POS = 0x208E
+    R_MAX_RPM_POS = 0x208F
+
+    L_CMD_REL_POS_HI = 0x208A
+    L_CMD_REL_POS_LO = 0x208B
+    R_CMD_REL_POS_HI = 0x208C
+    R_CMD_REL_POS_LO = 0x208D
+
+    L_FB_POS_HI = 0x20A7
+    L_FB_POS_LO = 0x20A8
+    R_FB_POS_HI = 0x20A9
+    R_FB_POS_LO = 0x20AA
+
+    ## Troubleshooting
+    L_FAULT = 0x20A5
+    R_FAULT = 0x20A6
+
+    ########################
+    ## Control CMDs (REG) ##
+    ########################
+    EMER_STOP = 0x05
+    ALRM_CLR = 0x06
+    DOWN_TIME = 0x07
+    ENABLE = 0x08
+    POS_SYNC = 0x10
+    POS_L_START = 0x11
+    POS_R_START = 0x12
+
+    ####################
+    ## Operation Mode ##
+    ####################
+    POS_REL_CONTROL = 1
+    POS_ABS_CONTROL = 2
+    VEL_CONTROL = 3
+
+    ASYNC = 0
+    SYNC = 1
+
+    #################
+    ## Fault codes ##
+    #################
+    NO_FAULT = 0x0000
+    OVER_VOLT = 0x0001
+    UNDER_VOLT = 0x0002
+    OVER_CURR = 0x0004
+    OVER_LOAD = 0x0008
+    CURR_OUT_TOL = 0x0010
+    ENCOD_OUT_TOL = 0x0020
+    MOTOR_BAD = 0x0040
+    REF_VOLT_ERROR = 0x0080
+    EEPROM_ERROR = 0x0100
+    WALL_ERROR = 0x0200
+    HIGH_TEMP = 0x0400
+    FAULT_LIST = [
+        OVER_VOLT,
+        UNDER_VOLT,
+        OVER_CURR,
+        OVER_LOAD,
+        CURR_OUT_TOL,
+        ENCOD_OUT_TOL,
+        MOTOR_BAD,
+        REF_VOLT_ERROR,
+        EEPROM_ERROR,
+        WALL_ERROR,
+        HIGH_TEMP,
+    ]
+    FAULT_MASK = (
+        OVER_VOLT
+        | UNDER_VOLT
+        | OVER_CURR
+        | OVER_LOAD
+        | CURR_OUT_TOL
+        | ENCOD_OUT_TOL
+        | MOTOR_BAD
+        | REF_VOLT_ERROR
+        | EEPROM_ERROR
+        | WALL_ERROR
+        | HIGH_TEMP
+    )
+
+    ## Settings shared by Controller and AsyncController, self.client must already exist
+    def _setup(self, **kwargs):
+        baudrate = kwargs.get("baudrate", 115200)
 
         self.ID = kwargs.get("slave_id", 1)
 
-        ######################
-        ## Register Address ##
-        ######################
-        ## Common
-        self.CONTROL_REG = 0x200E
-        self.OPR_MODE = 0x200D
-        self.L_ACL_TIME = 0x2080
-        self.R_ACL_TIME = 0x2081
-        self.L_DCL_TIME = 0x2082
-        self.R_DCL_TIME = 0x2083
-
-        ## Velocity control
-        self.L_CMD_RPM = 0x2088
-        self.R_CMD_RPM = 0x2089
-        self.L_FB_RPM = 0x20AB
-        self.R_FB_RPM = 0x20AC
-
-        ## Position control
-        self.POS_CONTROL_TYPE = 0x200F
-
-        self.L_MAX_RPM_POS = 0x208E
-        self.R_MAX_RPM_POS = 0x208F
-
-        self.L_CMD_REL_POS_HI = 0x208A
-        self.L_CMD_REL_POS_LO = 0x208B
-        self.R_CMD_REL_POS_HI = 0x208C
-        self.R_CMD_REL_POS_LO = 0x208D
-
-        self.L_FB_POS_HI = 0x20A7
-        self.L_FB_POS_LO = 0x20A8
-        self.R_FB_POS_HI = 0x20A9
-        self.R_FB_POS_LO = 0x20AA
-
-        ## Troubleshooting
-        self.L_FAULT = 0x20A5
-        self.R_FAULT = 0x20A6
-
-        ########################
-        ## Control CMDs (REG) ##
-        ########################
-        self.EMER_STOP = 0x05
-        self.ALRM_CLR = 0x06
-        self.DOWN_TIME = 0x07
-        self.ENABLE = 0x08
-        self.POS_SYNC = 0x10
-        self.POS_L_START = 0x11
-        self.POS_R_START = 0x12
-
-        ####################
-        ## Operation Mode ##
-        ####################
-        self.POS_REL_CONTROL = 1
-        self.POS_ABS_CONTROL = 2
-        self.VEL_CONTROL = 3
-
-        self.ASYNC = 0
-        self.SYNC = 1
-
-        #################
-        ## Fault codes ##
-        #################
-        self.NO_FAULT = 0x0000
-        self.OVER_VOLT = 0x0001
-        self.UNDER_VOLT = 0x0002
-        self.OVER_CURR = 0x0004
-        self.OVER_LOAD = 0x0008
-        self.CURR_OUT_TOL = 0x0010
-        self.ENCOD_OUT_TOL = 0x0020
-        self.MOTOR_BAD = 0x0040
-        self.REF_VOLT_ERROR = 0x0080
-        self.EEPROM_ERROR = 0x0100
-        self.WALL_ERROR = 0x0200
-        self.HIGH_TEMP = 0x0400
-        self.FAULT_LIST = [
-            self.OVER_VOLT,
-            self.UNDER_VOLT,
-            self.OVER_CURR,
-            self.OVER_LOAD,
-            self.CURR_OUT_TOL,
-            self.ENCOD_OUT_TOL,
-            self.MOTOR_BAD,
-            self.REF_VOLT_ERROR,
-            self.EEPROM_ERROR,
-            self.WALL_ERROR,
-            self.HIGH_TEMP,
-        ]
+        ## Modbus RTU silent interval: 3.5 chars of 11 bits each, the spec fixes it
+        ## at 1.75 ms above 19200 baud
+        self._silent_interval = 3.5 * 11 / baudrate
+        if baudrate > 19200:
+            self._silent_interval = max(self._silent_interval, 1.75e-3)
+        self._last_tx = 0.0  # end of the last request/response on the bus
+        self.max_retries = kwargs.get("max_retries", 10)
 
         ##############
         ## Odometry ##
         ##############
         self.R_Wheel = kwargs.get("wheel_radius", 0.065)  # radius of wheel in meter
-        self.travel_in_one_rev = 2 * np.pi * self.R_Wheel
+        self.travel_in_one_rev = 2 * math.pi * self.R_Wheel
         self.cpr = 16384  # counts per revolution
 
-    ## Some time if read immediatly after write, it would show ModbusIOException when get data from registers
-    def modbus_fail_read_handler(self, ADDR, WORD):
-        read_success = False
-        reg = [None] * WORD
-        while not read_success:
-            result = self.client.read_holding_registers(ADDR, WORD, slave=self.ID)
-            try:
-                for i in range(WORD):
-                    reg[i] = result.registers[i]
-                read_success = True
-            except AttributeError as e:
-                print(e)
-                pass
+        ## Conversion factors, computed once
+        self._rpm_to_lin = 2 * math.pi / 60.0 * self.R_Wheel  # rpm -> m/s
+        self._lin_to_rpm = 1.0 / self._rpm_to_lin  # m/s -> rpm
+        self._pulse_to_m = self.travel_in_one_rev / self.cpr  # tick -> meter
+        self._deg_to_dec = 65536.0 / 1440.0  # deg -> relative position command
+
+        ## Last position feedback as (timestamp, l_tick, r_tick), reused for pos_cache_ttl seconds
+        self._pos_cache = None
+        self._pos_cache_ttl = kwargs.get("pos_cache_ttl", 0.002)
+
+        ## Last successful write per start address as {ADDR: (values, result)}
+        self._last_written = {}
+
+    ## USB-serial adapters hold received bytes for up to 16 ms by default, which delays
+    ## every response; ASYNC_LOW_LATENCY makes the Linux driver pass them on immediately
+    def set_low_latency(self):
+        try:
+            self._serial_port().set_low_latency_mode(True)
+        except (AttributeError, IOError, ValueError) as e:
+            log.warning("set_low_latency ERROR: %s", e)
+            return False
+
+        return True
+
+    ## Setpoints are often resent unchanged every cycle, so a write is skipped when the
+    ## registers already hold the same values unless force is set
+    def _lookup_written(self, ADDR, values, force):
+        cached = self._last_written.get(ADDR)
+        if not force and cached is not None and cached[0] == values:
+            return cached[1]
+
+        self._forget_written(ADDR, len(values))
+        return None
 
-        return reg
+    def _store_written(self, ADDR, values, result):
+        if not result.isError():
+            self._last_written[ADDR] = (values, result)
+
+        return result
+
+    ## Drop cached writes overlapping ADDR..ADDR+WORD-1
+    def _forget_written(self, ADDR, WORD):
+        for start in list(self._last_written):
+            if start < ADDR + WORD and ADDR < start + len(self._last_written[start][0]):
+                del self._last_written[start]
 
     def rpm_to_linear(self, rpm):
-        return rpm / 60.0 * self.travel_in_one_rev
+        return rpm * self._rpm_to_lin
 
     def linear_to_rpm(self, linear):
-        return linear / self.travel_in_one_rev * 60.0
+        return linear * self._lin_to_rpm
+
+    def map(self, val, in_min, in_max, out_min, out_max):
+        return (val - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
-    def set_mode(self, MODE):
+    def deg_to_32bitArray(self, deg):
+        dec = int(deg * self._deg_to_dec) & 0xFFFFFFFF
+
+        return [dec >> 16, dec & 0xFFFF]
+
+    ##########################################
+    ## Register values, shared by both APIs ##
+    ##########################################
+    def _prepare_mode(self, MODE):
         if MODE == 1:
-            print("Set relative position control")
+            log.debug("Set relative position control")
         elif MODE == 2:
-            print("Set absolute position control")
+            log.debug("Set absolute position control")
         elif MODE == 3:
-            print("Set speed rpm control")
+            log.debug("Set speed rpm control")
         else:
-            print("set_mode ERROR: set only 1, 2, or 3")
-            return 0
+            log.error("set_mode ERROR: set only 1, 2, or 3")
+            raise ValueError("invalid mode {}, set only 1, 2, or 3".format(MODE))
+
+        self._pos_cache = None
+        ## Cached setpoints belong to the previous mode, so they must be written again
+        cached = self._last_written.get(self.OPR_MODE)
+        if cached is None or cached[0] != (MODE,):
+            self._last_written.clear()
+
+    def _ms_regs(self, *ms):
+        return [max(0, min(32767, int(v))) for v in ms]
+
+    def _rpm_regs(self, L_rpm, R_rpm):
+        return [
+            max(-3000, min(3000, int(L_rpm))) & 0xFFFF,
+            max(-3000, min(3000, int(R_rpm))) & 0xFFFF,
+        ]
 
-        return self.client.write_register(self.OPR_MODE, MODE, slave=self.ID)
+    def _max_rpm_pos_regs(self, max_L_rpm, max_R_rpm):
+        return [max(1, min(1000, int(max_L_rpm))), max(1, min(1000, int(max_R_rpm)))]
 
-    def get_mode(self):
-        registers = self.modbus_fail_read_handler(self.OPR_MODE, 1)
+    def _rel_angle_regs(self, ang_L, ang_R):
+        L_HI, L_LO = self.deg_to_32bitArray(ang_L)
+        R_HI, R_LO = self.deg_to_32bitArray(ang_R)
 
-        mode = registers[0]
+        return [L_HI, L_LO, R_HI, R_LO]
+
+    def _decode_fault(self, registers):
+        L_fault_code = registers[0]
+        R_fault_code = registers[1]
+
+        ## Fault codes are bit flags, so several faults may be set at once
+        L_fault_flag = bool(L_fault_code & self.FAULT_MASK)
+        R_fault_flag = bool(R_fault_code & self.FAULT_MASK)
+
+        ## A faulted driver may have dropped its setpoints, so write them again
+        if L_fault_flag or R_fault_flag:
+            self._last_written.clear()
+
+        return (L_fault_flag, L_fault_code), (R_fault_flag, R_fault_code)
+
+    ## A mode other than the one last written means the driver was reset or
+    ## reconfigured behind our back, so none of the cached writes can be trusted
+    def _check_mode(self, mode):
+        cached = self._last_written.get(self.OPR_MODE)
+        if cached is not None and cached[0] != (mode,):
+            self._last_written.clear()
 
         return mode
 
-    def enable_motor(self):
-        return self.client.write_register(self.CONTROL_REG, self.ENABLE, slave=self.ID)
+    def _decode_rpm(self, registers):
+        ## sign-extend the 16-bit words, unit in 0.1 rpm
+        fb_L_rpm = ((registers[0] ^ 0x8000) - 0x8000) / 10.0
+        fb_R_rpm = ((registers[1] ^ 0x8000) - 0x8000) / 10.0
 
-    def disable_motor(self):
-        return self.client.write_register(
-            self.CONTROL_REG, self.DOWN_TIME, slave=self.ID
-        )
+        return fb_L_rpm, fb_R_rpm
 
-    def get_fault_code(self):
-        fault_codes = self.client.read_holding_registers(self.L_FAULT, 2, slave=self.ID)
+    def _decode_travelled(self, ticks):
+        l_tick, r_tick = ticks
+
+        l_travelled = float(l_tick) * self._pulse_to_m  # unit in meter
+        r_travelled = float(r_tick) * self._pulse_to_m  # unit in meter
 
-        L_fault_code = fault_codes.registers[0]
-        R_fault_code = fault_codes.registers[1]
+        return l_travelled, r_travelled
 
-        L_fault_flag = L_fault_code in self.FAULT_LIST
-        R_fault_flag = R_fault_code in self.FAULT_LIST
+    ## Ticks from the last read if it is younger than pos_cache_ttl, else None
+    def _cached_ticks(self):
+        if self._pos_cache is not None:
+            timestamp, l_tick, r_tick = self._pos_cache
+            if time.monotonic() - timestamp < self._pos_cache_ttl:
+                return l_tick, r_tick
 
-        return (L_fault_flag, L_fault_code), (R_fault_flag, R_fault_code)
+        return None
 
-    def clear_alarm(self):
-        return self.client.write_register(
-            self.CONTROL_REG, self.ALRM_CLR, slave=self.ID
+    def _decode_ticks(self, registers):
+        l_tick, r_tick = _POS_UNPACK(_POS_PACK(*registers))
+
+        self._pos_cache = (time.monotonic(), l_tick, r_tick)
+
+        return l_tick, r_tick
+
+    def _decode_status(self, registers):
+        L_fault_code, R_fault_code, l_tick, r_tick, L_rpm, R_rpm = _STATUS_UNPACK(
+            _STATUS_PACK(*registers)
         )
+        self._pos_cache = (time.monotonic(), l_tick, r_tick)
 
-    def set_accel_time(self, L_ms, R_ms):
-        if L_ms > 32767:
-            L_ms = 32767
-        elif L_ms < 0:
-            L_ms = 0
+        return {
+            "fault": self._decode_fault([L_fault_code, R_fault_code]),
+            "tick": (l_tick, r_tick),
+            "rpm": (L_rpm / 10.0, R_rpm / 10.0),  # unit in 0.1 rpm
+        }
 
-        if R_ms > 32767:
-            R_ms = 32767
-        elif R_ms < 0:
-            R_ms = 0
 
-        return self.client.write_registers(
-            self.L_ACL_TIME, [int(L_ms), int(R_ms)], slave=self.ID
+class Controller(_ControllerBase):
+    def __init__(self, **kwargs):
+        self.client = ModbusClient(
+            method="rtu",
+            port=kwargs.get("port", "/dev/ttyUSB0"),
+            baudrate=kwargs.get("baudrate", 115200),
+            timeout=kwargs.get(
+                "timeout", _default_timeout(kwargs.get("baudrate", 115200))
+            ),
         )
 
-    def set_decel_time(self, L_ms, R_ms):
-        L_ms = np.clip(L_ms, 0, 32767)
-        R_ms = np.clip(R_ms, 0, 32767)
+        self.client.connect()
+        if kwargs.get("low_latency", False):
+            self.set_low_latency()
+
+        self._setup(**kwargs)
+
+        ## Requests for the feedback reads done every cycle, built once and reused
+        self._read_requests = {}
+        if _PREBUILT_REQUESTS:
+            for ADDR, WORD in [
+                (self.L_FB_RPM, 2),
+                (self.L_FB_POS_HI, 4),
+                (self.L_FB_POS_HI, 6),
+                (self.L_FAULT, 2),
+                (self.L_FAULT, 8),
+            ]:
+                self._read_requests[(ADDR, WORD)] = ReadHoldingRegistersRequest(
+                    ADDR, WORD, slave=self.ID
+                )
+
+    def _serial_port(self):
+        return self.client.socket
+
+    ## Keep at least one silent interval between frames, else the driver may merge
+    ## back-to-back requests and answer with an error or not at all
+    def _bus_call(self, fn, *args, **kwargs):
+        dt = self._last_tx + self._silent_interval - time.monotonic()
+        if dt > 0:
+            time.sleep(dt)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._last_tx = time.monotonic()
+
+    ## Drop leftovers of a timed out response before reading, else they corrupt the next
+    ## one. pymodbus 3.x's send() already drains the port before every request, so this
+    ## only matters for clients that don't
+    def _safe_read(self, ADDR, WORD):
+        try:
+            self._serial_port().reset_input_buffer()
+        except AttributeError:
+            pass
+
+        request = self._read_requests.get((ADDR, WORD))
+        if request is not None:
+            return self._bus_call(self.client.execute, request)
+
+        return self._bus_call(
+            self.client.read_holding_registers, ADDR, WORD, slave=self.ID
+        )
 
-        return self.client.write_registers(
-            self.L_DCL_TIME, [int(L_ms), int(R_ms)], slave=self.ID
+    ## Some time if read immediatly after write, it would show ModbusIOException when get data from registers
+    def modbus_fail_read_handler(self, ADDR, WORD):
+        for _ in range(self.max_retries):
+            result = self._safe_read(ADDR, WORD)
+            if not result.isError() and hasattr(result, "registers"):
+                return result.registers
+
+        raise ModbusIOException(
+            "failed to read {} register(s) at 0x{:04X} after {} attempts".format(
+                WORD, ADDR, self.max_retries
+            )
         )
 
-    def to_int16(self, val):
-        return 0xFFFF & int(val)
+    def _write_cached(self, ADDR, values, force=False):
+        values = tuple(values)
+        cached = self._lookup_written(ADDR, values, force)
+        if cached is not None:
+            return cached
+
+        if len(values) == 1:
+            result = self._bus_call(
+                self.client.write_register, ADDR, values[0], slave=self.ID
+            )
+        else:
+            result = self._bus_call(
+                self.client.write_registers, ADDR, list(values), slave=self.ID
+            )
 
-    def set_rpm(self, L_rpm, R_rpm):
-        left_bytes = self.to_int16(np.clip(L_rpm, -3000, 3000))
-        right_bytes = self.to_int16(np.clip(R_rpm, -3000, 3000))
+        return self._store_written(ADDR, values, result)
 
-        return self.client.write_registers(
-            self.L_CMD_RPM, [left_bytes, right_bytes], slave=self.ID
+    def _write_control(self, CMD):
+        return self._bus_call(
+            self.client.write_register, self.CONTROL_REG, CMD, slave=self.ID
         )
 
-    def set_speed(self, L_speed, R_speed):
+    def set_mode(self, MODE, force=False):
+        self._prepare_mode(MODE)
+
+        return self._write_cached(self.OPR_MODE, [MODE], force)
+
+    def get_mode(self):
+        registers = self.modbus_fail_read_handler(self.OPR_MODE, 1)
+
+        mode = registers[0]
+
+        return self._check_mode(mode)
+
+    def enable_motor(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return self._write_control(self.ENABLE)
+
+    def disable_motor(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return self._write_control(self.DOWN_TIME)
+
+    def get_fault_code(self):
+        registers = self.modbus_fail_read_handler(self.L_FAULT, 2)
+
+        return self._decode_fault(registers)
+
+    def clear_alarm(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return self._write_control(self.ALRM_CLR)
+
+    def set_accel_time(self, L_ms, R_ms, force=False):
+        return self._write_cached(self.L_ACL_TIME, self._ms_regs(L_ms, R_ms), force)
+
+    def set_decel_time(self, L_ms, R_ms, force=False):
+        return self._write_cached(self.L_DCL_TIME, self._ms_regs(L_ms, R_ms), force)
+
+    ## Accel (0x2080..0x2081) and decel (0x2082..0x2083) times are contiguous,
+    ## so both pairs are written in one frame
+    def set_accel_decel(self, L_acl_ms, R_acl_ms, L_dcl_ms, R_dcl_ms, force=False):
+        return self._write_cached(
+            self.L_ACL_TIME,
+            self._ms_regs(L_acl_ms, R_acl_ms, L_dcl_ms, R_dcl_ms),
+            force,
+        )
+
+    def set_rpm(self, L_rpm, R_rpm, force=False):
+        self._pos_cache = None
+
+        return self._write_cached(self.L_CMD_RPM, self._rpm_regs(L_rpm, R_rpm), force)
+
+    def set_speed(self, L_speed, R_speed, force=False):
         left_rpm = self.linear_to_rpm(L_speed)
         right_rpm = self.linear_to_rpm(R_speed)
-        return self.set_rpm(left_rpm, right_rpm)
+        return self.set_rpm(left_rpm, right_rpm, force)
 
-    def get_rpm(self):
-        registers = self.modbus_fail_read_handler(self.L_FB_RPM, 2)
-        fb_L_rpm = np.int16(registers[0]) / 10.0  # unit in 0.1 rpm
-        fb_R_rpm = np.int16(registers[1]) / 10.0
+    def get_rpm(self, registers=None):
+        if registers is None:
+            registers = self.modbus_fail_read_handler(self.L_FB_RPM, 2)
 
-        return fb_L_rpm, fb_R_rpm
+        return self._decode_rpm(registers)
 
-    def get_linear_velocities(self):
-        rpmL, rpmR = self.get_rpm()
+    def get_linear_velocities(self, registers=None):
+        rpmL, rpmR = self.get_rpm(registers)
 
         VL = self.rpm_to_linear(rpmL)
         VR = self.rpm_to_linear(rpmR)
 
         return VL, VR
 
-    def map(self, val, in_min, in_max, out_min, out_max):
-        return (val - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
+    def set_maxRPM_pos(self, max_L_rpm, max_R_rpm, force=False):
+        return self._write_cached(
+            self.L_MAX_RPM_POS, self._max_rpm_pos_regs(max_L_rpm, max_R_rpm), force
+        )
+
+    def set_position_async_control(self, force=False):
+        return self._write_cached(self.POS_CONTROL_TYPE, [self.ASYNC], force)
+
+    def set_position_sync_control(self, force=False):
+        return self._write_cached(self.POS_CONTROL_TYPE, [self.SYNC], force)
 
-    def set_maxRPM_pos(self, max_L_rpm, max_R_rpm):
-        max_L_rpm = np.clip(max_L_rpm, 1, 1000)
-        max_R_rpm = np.clip(max_R_rpm, 1, 1000)
+    def move_left_wheel(self):
+        self._pos_cache = None
+        return self._write_control(self.POS_L_START)
+
+    def move_right_wheel(self):
+        self._pos_cache = None
+        return self._write_control(self.POS_R_START)
+
+    def set_relative_angle(self, ang_L, ang_R):
+        self._pos_cache = None
 
-        return self.client.write_registers(
-            self.L_MAX_RPM_POS, [int(max_L_rpm), int(max_R_rpm)], slave=self.ID
+        return self._write_cached(
+            self.L_CMD_REL_POS_HI, self._rel_angle_regs(ang_L, ang_R), force=True
         )
 
-    def set_position_async_control(self):
-        return self.client.write_register(
-            self.POS_CONTROL_TYPE, self.ASYNC, slave=self.ID
+    ## Relative position (0x208A..0x208D) and max RPM (0x208E..0x208F) are contiguous,
+    ## so the whole move is written in one frame, then both wheels are started together.
+    ## POS_SYNC only starts a move in synchronous position control, so that is set first.
+    def command_move(self, ang_L, ang_R, max_L_rpm, max_R_rpm):
+        self._pos_cache = None
+        self.set_position_sync_control()
+
+        self._write_cached(
+            self.L_CMD_REL_POS_HI,
+            self._rel_angle_regs(ang_L, ang_R)
+            + self._max_rpm_pos_regs(max_L_rpm, max_R_rpm),
+            force=True,
         )
 
-    def move_left_wheel(self):
-        return self.client.write_register(
-            self.CONTROL_REG, self.POS_L_START, slave=self.ID
+        return self._write_control(self.POS_SYNC)
+
+    def get_wheels_travelled(self, registers=None):
+        return self._decode_travelled(self.get_wheels_tick(registers))
+
+    def get_wheels_tick(self, registers=None):
+        if registers is None:
+            ticks = self._cached_ticks()
+            if ticks is not None:
+                return ticks
+
+            registers = self.modbus_fail_read_handler(self.L_FB_POS_HI, 4)
+
+        return self._decode_ticks(registers)
+
+    ## Position (0x20A7..0x20AA) and RPM (0x20AB..0x20AC) feedback are contiguous,
+    ## so both can be fetched with a single read instead of two round-trips
+    def get_state(self):
+        registers = self.modbus_fail_read_handler(self.L_FB_POS_HI, 6)
+
+        ticks = self.get_wheels_tick(registers[0:4])
+        rpms = self.get_rpm(registers[4:6])
+
+        return ticks, rpms
+
+    ## Faults (0x20A5..0x20A6), position (0x20A7..0x20AA) and RPM (0x20AB..0x20AC)
+    ## feedback are contiguous, so the full status comes back in a single read
+    def get_all_status(self, registers=None):
+        if registers is None:
+            registers = self.modbus_fail_read_handler(self.L_FAULT, 8)
+
+        return self._decode_status(registers)
+
+
+## Same API as Controller, but every method that talks to the driver is a coroutine.
+## Requests are serialized with a lock since the RTU bus can only carry one at a time.
+class AsyncController(_ControllerBase):
+    def __init__(self, **kwargs):
+        self.client = AsyncModbusClient(
+            method="rtu",
+            port=kwargs.get("port", "/dev/ttyUSB0"),
+            baudrate=kwargs.get("baudrate", 115200),
+            timeout=kwargs.get(
+                "timeout", _default_timeout(kwargs.get("baudrate", 115200))
+            ),
+            ## pymodbus closes the port after a timeout and reopens it in the
+            ## background; reconnect in _bus_call instead so retries don't race it
+            reconnect_delay=0,
         )
+        self._lock = asyncio.Lock()
+        self._low_latency = kwargs.get("low_latency", False)
 
-    def move_right_wheel(self):
-        return self.client.write_register(
-            self.CONTROL_REG, self.POS_R_START, slave=self.ID
+        self._setup(**kwargs)
+
+    ## The serial port only exists once connected, so low_latency is applied here
+    async def connect(self):
+        connected = await self.client.connect()
+        if connected and self._low_latency:
+            self.set_low_latency()
+
+        return connected
+
+    ## pymodbus >= 3.5 has its own serial transport, older versions use pyserial-asyncio
+    def _serial_port(self):
+        transport = self.client.transport
+        return getattr(transport, "sync_serial", None) or transport.serial
+
+    async def _bus_call(self, fn, *args, **kwargs):
+        async with self._lock:
+            if not self.client.connected:
+                await self.connect()
+
+            dt = self._last_tx + self._silent_interval - time.monotonic()
+            if dt > 0:
+                await asyncio.sleep(dt)
+
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self._last_tx = time.monotonic()
+
+    ## The protocol drains the serial port as bytes arrive, so leftovers of a timed out
+    ## response sit in pymodbus's own buffers; drop them before reading
+    def _reset_rx(self):
+        try:
+            self.client.framer.resetFrame()
+        except AttributeError:
+            pass
+        if hasattr(self.client, "recv_buffer"):
+            self.client.recv_buffer = b""
+
+    async def _safe_read(self, ADDR, WORD):
+        ## Reset inside the bus lock, so a response still on its way to another task
+        ## is not thrown away
+        async def read():
+            self._reset_rx()
+            return await self.client.read_holding_registers(ADDR, WORD, slave=self.ID)
+
+        return await self._bus_call(read)
+
+    async def modbus_fail_read_handler(self, ADDR, WORD):
+        for _ in range(self.max_retries):
+            ## Unlike the sync client, a timeout raises here instead of returning an error
+            try:
+                result = await self._safe_read(ADDR, WORD)
+            except (ModbusIOException, ConnectionException, asyncio.TimeoutError):
+                continue
+            if not result.isError() and hasattr(result, "registers"):
+                return result.registers
+
+        raise ModbusIOException(
+            "failed to read {} register(s) at 0x{:04X} after {} attempts".format(
+                WORD, ADDR, self.max_retries
+            )
         )
 
-    def deg_to_32bitArray(self, deg):
-        dec = int(self.map(deg, -1440, 1440, -65536, 65536))
-        HI_WORD = (dec & 0xFFFF0000) >> 16
-        LO_WORD = dec & 0x0000FFFF
+    async def _write_cached(self, ADDR, values, force=False):
+        values = tuple(values)
+        cached = self._lookup_written(ADDR, values, force)
+        if cached is not None:
+            return cached
 
-        return [HI_WORD, LO_WORD]
+        if len(values) == 1:
+            result = await self._bus_call(
+                self.client.write_register, ADDR, values[0], slave=self.ID
+            )
+        else:
+            result = await self._bus_call(
+                self.client.write_registers, ADDR, list(values), slave=self.ID
+            )
 
-    def set_relative_angle(self, ang_L, ang_R):
-        L_array = self.deg_to_32bitArray(ang_L)
-        R_array = self.deg_to_32bitArray(ang_R)
-        all_cmds_array = L_array + R_array
+        return self._store_written(ADDR, values, result)
 
-        return self.client.write_registers(
-            self.L_CMD_REL_POS_HI, all_cmds_array, slave=self.ID
+    async def _write_control(self, CMD):
+        return await self._bus_call(
+            self.client.write_register, self.CONTROL_REG, CMD, slave=self.ID
         )
 
-    def get_wheels_travelled(self):
-        registers = self.modbus_fail_read_handler(self.L_FB_POS_HI, 4)
-        l_pul_hi = registers[0]
-        l_pul_lo = registers[1]
-        r_pul_hi = registers[2]
-        r_pul_lo = registers[3]
-
-        l_pulse = np.int32(((l_pul_hi & 0xFFFF) << 16) | (l_pul_lo & 0xFFFF))
-        r_pulse = np.int32(((r_pul_hi & 0xFFFF) << 16) | (r_pul_lo & 0xFFFF))
-        l_travelled = (
-            float(l_pulse) / self.cpr
-        ) * self.travel_in_one_rev  # unit in meter
-        r_travelled = (
-            float(r_pulse) / self.cpr
-        ) * self.travel_in_one_rev  # unit in meter
+    async def set_mode(self, MODE, force=False):
+        self._prepare_mode(MODE)
 
-        return l_travelled, r_travelled
+        return await self._write_cached(self.OPR_MODE, [MODE], force)
 
-    def get_wheels_tick(self):
-        registers = self.modbus_fail_read_handler(self.L_FB_POS_HI, 4)
-        l_pul_hi = registers[0]
-        l_pul_lo = registers[1]
-        r_pul_hi = registers[2]
-        r_pul_lo = registers[3]
+    async def get_mode(self):
+        registers = await self.modbus_fail_read_handler(self.OPR_MODE, 1)
 
-        l_tick = np.int32(((l_pul_hi & 0xFFFF) << 16) | (l_pul_lo & 0xFFFF))
-        r_tick = np.int32(((r_pul_hi & 0xFFFF) << 16) | (r_pul_lo & 0xFFFF))
+        return self._check_mode(registers[0])
 
-        return l_tick, r_tick
+    async def enable_motor(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return await self._write_control(self.ENABLE)
+
+    async def disable_motor(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return await self._write_control(self.DOWN_TIME)
+
+    async def get_fault_code(self):
+        registers = await self.modbus_fail_read_handler(self.L_FAULT, 2)
+
+        return self._decode_fault(registers)
+
+    async def clear_alarm(self):
+        self._pos_cache = None
+        self._last_written.clear()
+        return await self._write_control(self.ALRM_CLR)
+
+    async def set_accel_time(self, L_ms, R_ms, force=False):
+        return await self._write_cached(
+            self.L_ACL_TIME, self._ms_regs(L_ms, R_ms), force
+        )
+
+    async def set_decel_time(self, L_ms, R_ms, force=False):
+        return await self._write_cached(
+            self.L_DCL_TIME, self._ms_regs(L_ms, R_ms), force
+        )
+
+    async def set_accel_decel(
+        self, L_acl_ms, R_acl_ms, L_dcl_ms, R_dcl_ms, force=False
+    ):
+        return await self._write_cached(
+            self.L_ACL_TIME,
+            self._ms_regs(L_acl_ms, R_acl_ms, L_dcl_ms, R_dcl_ms),
+            force,
+        )
+
+    async def set_rpm(self, L_rpm, R_rpm, force=False):
+        self._pos_cache = None
+
+        return await self._write_cached(
+            self.L_CMD_RPM, self._rpm_regs(L_rpm, R_rpm), force
+        )
+
+    async def set_speed(self, L_speed, R_speed, force=False):
+        left_rpm = self.linear_to_rpm(L_speed)
+        right_rpm = self.linear_to_rpm(R_speed)
+        return await self.set_rpm(left_rpm, right_rpm, force)
+
+    async def get_rpm(self, registers=None):
+        if registers is None:
+            registers = await self.modbus_fail_read_handler(self.L_FB_RPM, 2)
+
+        return self._decode_rpm(registers)
+
+    async def get_linear_velocities(self, registers=None):
+        rpmL, rpmR = await self.get_rpm(registers)
+
+        return self.rpm_to_linear(rpmL), self.rpm_to_linear(rpmR)
+
+    async def set_maxRPM_pos(self, max_L_rpm, max_R_rpm, force=False):
+        return await self._write_cached(
+            self.L_MAX_RPM_POS, self._max_rpm_pos_regs(max_L_rpm, max_R_rpm), force
+        )
+
+    async def set_position_async_control(self, force=False):
+        return await self._write_cached(self.POS_CONTROL_TYPE, [self.ASYNC], force)
+
+    async def set_position_sync_control(self, force=False):
+        return await self._write_cached(self.POS_CONTROL_TYPE, [self.SYNC], force)
+
+    async def move_left_wheel(self):
+        self._pos_cache = None
+        return await self._write_control(self.POS_L_START)
+
+    async def move_right_wheel(self):
+        self._pos_cache = None
+        return await self._write_control(self.POS_R_START)
+
+    async def set_relative_angle(self, ang_L, ang_R):
+        self._pos_cache = None
+
+        return await self._write_cached(
+            self.L_CMD_REL_POS_HI, self._rel_angle_regs(ang_L, ang_R), force=True
+        )
+
+    async def command_move(self, ang_L, ang_R, max_L_rpm, max_R_rpm):
+        self._pos_cache = None
+        await self.set_position_sync_control()
+
+        await self._write_cached(
+            self.L_CMD_REL_POS_HI,
+            self._rel_angle_regs(ang_L, ang_R)
+            + self._max_rpm_pos_regs(max_L_rpm, max_R_rpm),
+            force=True,
+        )
+
+        return await self._write_control(self.POS_SYNC)
+
+    async def get_wheels_travelled(self, registers=None):
+        return self._decode_travelled(await self.get_wheels_tick(registers))
+
+    async def get_wheels_tick(self, registers=None):
+        if registers is None:
+            ticks = self._cached_ticks()
+            if ticks is not None:
+                return ticks
+
+            registers = await self.modbus_fail_read_handler(self.L_FB_POS_HI, 4)
+
+        return self._decode_ticks(registers)
+
+    async def get_state(self):
+        registers = await self.modbus_fail_read_handler(self.L_FB_POS_HI, 6)
+
+        return self._decode_ticks(registers[0:4]), self._decode_rpm(registers[4:6])
+
+    async def get_all_status(self, registers=None):
+        if registers is None:
+            registers = await self.modbus_fail_read_handler(self.L_FAULT, 8)
+
+        return self._decode_status(registers)